@@ -1 +1 @@
-from .cli import CLI, CLICommand, UnknownCommand, EmptyCommandLine, InvalidArguments, InvalidOptions
\ No newline at end of file
+from .cli import CLI, CLICommand, LazyInterpreter, UnknownCommand, EmptyCommandLine, InvalidArguments, InvalidOptions
\ No newline at end of file
@@ -1,4 +1,5 @@
-import getopt, textwrap, sys
+import getopt, textwrap, sys, importlib, shlex, io, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 class UnknownCommand(Exception):
     def __init__(self, command, argv):
@@ -32,6 +33,73 @@ def format_paragraph(indent, text):
     else:
         return [text.strip()]
     
+def split_command_line(line):
+    # returns argv list or None for empty lines and comments
+    if isinstance(line, (list, tuple)):
+        return list(line) or None
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    return shlex.split(line)
+
+def parse_command_lines(lines):
+    # yields (argv, None) for commands, (line, error message) for lines which can not be parsed
+    for line in lines:
+        try:
+            argv = split_command_line(line)
+        except ValueError as e:
+            yield line, f"Invalid command line {line.strip()!r}: {e}"
+            continue
+        if argv:
+            yield argv, None
+
+class ThreadLocalOutput(object):
+    
+    # Stand-in for sys.stdout/sys.stderr which sends output of each thread to its own buffer, if any
+    
+    def __init__(self, stream):
+        self.Stream = stream
+        self.Local = threading.local()
+        
+    def capture(self, buf):
+        self.Local.Buffer = buf
+        
+    def write(self, text):
+        buf = getattr(self.Local, "Buffer", None)
+        return (buf if buf is not None else self.Stream).write(text)
+        
+    def flush(self):
+        buf = getattr(self.Local, "Buffer", None)
+        if buf is None:
+            self.Stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.Stream, name)
+
+def run_command(cli, argv0, context, argv, usage_on_error):
+    # returns exit status of the command: 0 - success, 1 - error, 2 - invalid command line
+    try:
+        cli._run(argv0, context, argv, usage_on_error = usage_on_error)
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except (CLIException, UnknownCommand) as e:
+        print(e, file=sys.stderr)
+        return 2
+    except Exception as e:
+        print(f"{e.__class__.__name__}: {e}", file=sys.stderr)
+        return 1
+
+def run_command_captured(cli, argv0, context, argv, usage_on_error):
+    # runs in a worker process
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = out, err = io.StringIO(), io.StringIO()
+    try:
+        status = run_command(cli, argv0, context, argv, usage_on_error)
+    finally:
+        sys.stdout, sys.stderr = saved
+    return status, out.getvalue(), err.getvalue()
+
 class CLIInterpreter(object):
 
     Opts = ("", [])
@@ -136,6 +204,65 @@ class CLICommand(CLIInterpreter):
             usage = usage[len(word)+1:]
         return usage
 
+class LazyInterpreter(CLIInterpreter):
+    
+    #
+    # Placeholder for an interpreter which is imported and created only when its command is dispatched.
+    #   target: "module:Class" or "module:attribute" import string, or a factory callable returning the interpreter
+    #   usage: usage headline shown by usage() and help() without importing the target.
+    #       If not given, the headline is empty until the target is resolved
+    #
+    
+    def __init__(self, target, usage=None, hidden=False):
+        self.Target = target
+        self.UsageHeadline = usage
+        self.Hidden = hidden
+        self.Interpreter = None
+        
+    # class-level, so that LazyInterpreter stays picklable for run_batch with processes
+    ResolveLock = threading.RLock()
+
+    def resolve(self):
+        if self.Interpreter is not None:
+            return self.Interpreter
+        with self.ResolveLock:
+            if self.Interpreter is not None:
+                # resolved by another thread
+                return self.Interpreter
+            target = self.Target
+            if isinstance(target, str):
+                mod_name, _, attr_path = target.partition(":")
+                target = importlib.import_module(mod_name)
+                for attr in attr_path.split(".") if attr_path else []:
+                    target = getattr(target, attr)
+            interp = target
+            if not isinstance(interp, CLIInterpreter):
+                interp = interp()
+            if not isinstance(interp, CLIInterpreter):
+                raise ValueError("Unrecognized type of the interpreter: %s %s" % (type(interp), interp))
+            self.Interpreter = interp
+            return self.Interpreter
+        
+    def commands(self):
+        return self.resolve().commands()
+        
+    def usage(self, word=""):
+        if self.UsageHeadline is None:
+            # never import just to print usage, show the real usage only if already resolved
+            interp = self.Interpreter
+            if interp is None:
+                return ""
+            if isinstance(interp, CLI):
+                return ",".join(interp.commands())
+            return interp.usage(word)
+        usage = self.UsageHeadline
+        if word and usage.startswith(word + " "):
+            usage = usage[len(word)+1:]
+        return usage
+        
+    def _run(self, command, context, argv, usage_on_error = True):
+        return self.resolve()._run(command, context, argv, usage_on_error = usage_on_error)
+
 class CLI(CLIInterpreter):
     
     GNUStyle = False
@@ -148,6 +275,10 @@ class CLI(CLIInterpreter):
         i = 0
         while i < len(args):
             w, c = args[i], args[i+1]
+            if isinstance(c, tuple):
+                c = LazyInterpreter(*c)             # ("module:Class", "usage headline")
+            elif isinstance(c, str) or (callable(c) and not isinstance(c, CLIInterpreter)):
+                c = LazyInterpreter(c)
             self.Words.append(w)
             self.Interpreters[w] = c
             i += 2
@@ -215,6 +346,115 @@ class CLI(CLIInterpreter):
         command, argv = argv0, argv[1:]
         self._run(command, context, argv, usage_on_error)
         
+    def run_batch(self, lines, context=None, argv0="", workers=None, processes=False, 
+                usage_on_error=False, stop_on_error=False):
+        #
+        # Runs many command lines in this process with shared context.
+        #   lines: iterable of command line strings or argv lists, e.g. an open file or sys.stdin.
+        #       Empty lines and lines starting with "#" are ignored. Lines which can not be parsed get status 2
+        #   workers: if > 1, run the commands concurrently on a thread pool, or a process pool if processes=True.
+        #       With a process pool, the CLI object and the context must be picklable, and context changes are not shared.
+        #       Output of each command is buffered and printed in the order of the commands.
+        #   stop_on_error: sequential mode only, stop after first command with non-zero status
+        #
+        # Returns list of (argv, status) tuples, with the line itself instead of argv for unparsable lines
+        #
+        results = []
+        if not workers or workers <= 1:
+            # lines are parsed and run one by one, so that commands from a pipe run as they arrive
+            for argv, error in parse_command_lines(lines):
+                if error:
+                    print(error, file=sys.stderr)
+                    status = 2
+                else:
+                    status = run_command(self, argv0, context, argv, usage_on_error)
+                results.append((argv, status))
+                if status and stop_on_error:
+                    break
+            return results
+
+        commands = list(parse_command_lines(lines))
+
+        if processes:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [None if error else executor.submit(run_command_captured, self, argv0, context, argv, usage_on_error)
+                            for argv, error in commands]
+                for (argv, error), future in zip(commands, futures):
+                    if error:
+                        status, out, err = 2, "", error + "\n"
+                    else:
+                        try:
+                            status, out, err = future.result()
+                        except Exception as e:
+                            status, out, err = 1, "", f"{e.__class__.__name__}: {e}\n"
+                    sys.stdout.write(out)
+                    sys.stderr.write(err)
+                    results.append((argv, status))
+            return results
+
+        def run_captured(argv):
+            out, err = io.StringIO(), io.StringIO()
+            stdout.capture(out)
+            stderr.capture(err)
+            try:
+                status = run_command(self, argv0, context, argv, usage_on_error)
+            finally:
+                stdout.capture(None)
+                stderr.capture(None)
+            return status, out.getvalue(), err.getvalue()
+
+        saved = sys.stdout, sys.stderr
+        stdout, stderr = ThreadLocalOutput(sys.stdout), ThreadLocalOutput(sys.stderr)
+        sys.stdout, sys.stderr = stdout, stderr
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [None if error else executor.submit(run_captured, argv) for argv, error in commands]
+                for (argv, error), future in zip(commands, futures):
+                    if error:
+                        status, out, err = 2, "", error + "\n"
+                    else:
+                        status, out, err = future.result()
+                    saved[0].write(out)
+                    saved[1].write(err)
+                    results.append((argv, status))
+        finally:
+            sys.stdout, sys.stderr = saved
+        return results
+
+    def shell(self, context=None, argv0="", prompt="> ", usage_on_error=True):
+        # interactive prompt, reads and runs commands until EOF, "exit" or "quit"
+        # returns 0 on "exit" or "quit", status of the last command on EOF
+        try:
+            import readline
+        except ImportError:
+            pass
+        status = 0
+        while True:
+            try:
+                line = input(prompt)
+            except EOFError:
+                print()
+                break
+            except KeyboardInterrupt:
+                print()
+                continue
+            try:
+                argv = split_command_line(line)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                continue
+            if not argv:
+                continue
+            if argv[0] in ("exit", "quit"):
+                return 0
+            try:
+                status = run_command(self, argv0, context, argv, usage_on_error)
+            except KeyboardInterrupt:
+                # interrupt the command, not the shell
+                print()
+                status = 130
+        return status
+
     def format_usage_paragraph(self, indent=""):
         return "\n".join(format_paragraph(indent, self.UsageParagraph))
         
@@ -236,7 +476,9 @@ class CLI(CLIInterpreter):
         for w in self.Words:
             interp = self.Interpreters[w]
             if not interp.Hidden:
-                if isinstance(interp, CLI):
+                if isinstance(interp, LazyInterpreter):
+                    down_usage = interp.usage()
+                elif isinstance(interp, CLI):
                     down_usage = ",".join(interp.Words)
                 else:
                     down_usage = interp.usage()
@@ -271,7 +513,9 @@ class CLI(CLIInterpreter):
             for word in self.Words:
                 interp = self.Interpreters[word]
                 if not interp.Hidden:
-                    if isinstance(interp, CLI):
+                    if isinstance(interp, LazyInterpreter):
+                        out.append(indent + (fmt % (word, interp.usage(word))))
+                    elif isinstance(interp, CLI):
                         out.append(indent + (fmt % (word, ",".join(interp.commands()))))
                     elif isinstance(interp, CLICommand):
                         # assume CLICommand subclass
@@ -1,46 +1,185 @@
-import sys, importlib, os.path, getopt
-from pythreader import ShellCommand
+import sys, importlib.util, os, os.path, getopt, shutil, hashlib, json, marshal, zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 Usage = """
-python copy_modules.py [options] <module> [...] <out_dir>"
+python copy_modules.py [options] <module> [...] <out_dir>
+python copy_modules.py [options] -z <bundle.zip> <module> [...]
 options:
     -q                          - quiet, do not print status information
     -c                          - create output directory if does not exist. Raise an error otherwise.
+    -j <n>                      - number of parallel copy threads, default 8
+    -f                          - copy all files, even if they did not change
+    -H                          - detect changed files by content hash, kept in <out_dir>/.copy_modules.json,
+                                  instead of size and modification time
+    -z <bundle.zip>             - create zip bundle with precompiled .pyc files instead of copying to a directory
+    -S                          - do not include .py sources into the zip bundle
+    -e <module>[:<function>]    - add __main__.py calling the entry point, so that the bundle can run with "python <bundle>"
 """
 
-def copy_module(mod_name, out_dir):
-    mod = importlib.import_module(mod_name)
-    mod_file = mod.__file__
-    mod_dir, mod_file_name = os.path.split(mod.__file__)
-    if mod_file_name.startswith("__init__"):
-        cmd = f"/bin/cp -R {mod_dir} {out_dir}"
+ManifestName = ".copy_modules.json"
+
+def module_files(mod_name):
+    # locates the module without importing it (parent packages of a dotted name are still imported)
+    # returns list of (source path, relative destination path)
+    spec = importlib.util.find_spec(mod_name)
+    if spec is None:
+        raise RuntimeError(f"Module {mod_name} not found")
+    if spec.submodule_search_locations:
+        if spec.origin and os.path.isfile(spec.origin):
+            mod_dir = os.path.dirname(spec.origin)
+        else:
+            mod_dir = list(spec.submodule_search_locations)[0]         # namespace package
+        mod_dir = mod_dir.rstrip(os.sep)
+        top = os.path.dirname(mod_dir)
+        out = []
+        for dirpath, dirnames, filenames in os.walk(mod_dir):
+            dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+            for fn in sorted(filenames):
+                if not fn.endswith((".pyc", ".pyo")):
+                    path = os.path.join(dirpath, fn)
+                    out.append((path, os.path.relpath(path, top)))
+        return out
+    if not spec.origin or not os.path.isfile(spec.origin):
+        raise RuntimeError(f"Module {mod_name} is not a file: {spec.origin}")
+    return [(spec.origin, os.path.basename(spec.origin))]
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def unchanged(src, dst):
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns
+
+def copy_file(src, dst, force, manifest):
+    # returns (relative path, new hash or None, copied)
+    digest = None
+    if manifest is not None:
+        digest = file_hash(src)
+        if not force and os.path.isfile(dst) and manifest.get(dst) == digest:
+            return dst, digest, False
+    elif not force and unchanged(src, dst):
+        return dst, digest, False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copy2(src, dst)
+    return dst, digest, True
+
+def copy_files(files, out_dir, nthreads, force, use_hash):
+    manifest_path = os.path.join(out_dir, ManifestName)
+    manifest = None
+    if use_hash:
+        manifest = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = {os.path.join(out_dir, rel): digest for rel, digest in json.load(f).items()}
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        results = list(executor.map(
+            lambda sd: copy_file(sd[0], os.path.join(out_dir, sd[1]), force, manifest), files))
+    if use_hash:
+        manifest.update({dst: digest for dst, digest, _ in results})
+        with open(manifest_path, "w") as f:
+            json.dump({os.path.relpath(dst, out_dir): digest for dst, digest in manifest.items()}, f, indent=1, sort_keys=True)
+    return sum(1 for _, _, copied in results if copied)
+
+def compile_pyc(path, source):
+    # unchecked hash-based pyc (PEP 552), zipimport loads it without comparing to the source
+    code = compile(source, path, "exec", dont_inherit=True)
+    return importlib.util.MAGIC_NUMBER + (1).to_bytes(4, "little") + importlib.util.source_hash(source) + marshal.dumps(code)
+
+def read_and_compile(src, rel, with_sources):
+    with open(src, "rb") as f:
+        data = f.read()
+    entries = []
+    if rel.endswith(".py"):
+        entries.append((rel + "c", compile_pyc(rel, data)))
+        if with_sources:
+            entries.append((rel, data))
     else:
-        cmd = f"/bin/cp {mod_file} {out_dir}"
-    status, out, error = ShellCommand.execute(cmd)
-    if status != 0:
-        raise RuntimeError(f"Error copying module {mod_name}: {out}\n{error}")
+        entries.append((rel, data))
+    return entries
+
+def make_bundle(files, bundle_path, nthreads, with_sources, entry_point):
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        entries = list(executor.map(lambda sr: read_and_compile(sr[0], sr[1], with_sources), files))
+    tmp_path = bundle_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if entry_point:
+            f.write(b"#!/usr/bin/env python3\n")
+        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            if entry_point:
+                mod, _, func = entry_point.partition(":")
+                if func:
+                    main = f"import sys, {mod}\nsys.exit({mod}.{func}())\n"
+                else:
+                    main = f"import runpy\nrunpy.run_module({mod!r}, run_name='__main__', alter_sys=True)\n"
+                z.writestr("__main__.py", main)
+            entries = [(arcname.replace(os.sep, "/"), data) for file_entries in entries for arcname, data in file_entries]
+            # explicit directory entries, zipimport needs them to find namespace packages
+            dirs = set()
+            for arcname, _ in entries:
+                d = arcname.rsplit("/", 1)[0] if "/" in arcname else ""
+                while d and d not in dirs:
+                    dirs.add(d)
+                    d = d.rsplit("/", 1)[0] if "/" in d else ""
+            for d in sorted(dirs):
+                z.writestr(d + "/", b"")
+            for arcname, data in entries:
+                z.writestr(arcname, data)
+    if entry_point:
+        os.chmod(tmp_path, 0o755)
+    os.replace(tmp_path, bundle_path)
+    return len(entries)
 
-opts, args = getopt.getopt(sys.argv[1:], "qch?")
+opts, args = getopt.getopt(sys.argv[1:], "qch?j:fHz:Se:")
 opts = dict(opts)
 
-if not args or "-?" in opts or "-h" in opts:
+bundle = opts.get("-z")
+
+if not args or (bundle is None and len(args) < 2) or "-?" in opts or "-h" in opts:
     print(Usage)
     sys.exit(2)
 
-modules, out_dir = args[:-1], args[-1]
+if bundle is None:
+    modules, out_dir = args[:-1], args[-1]
+else:
+    modules, out_dir = args, None
 
-if not os.path.isdir(out_dir):
+nthreads = int(opts.get("-j", 8))
+
+if out_dir is not None and not os.path.isdir(out_dir):
     if "-c" in opts:
         os.makedirs(out_dir, mode=0o744)
     else:
         print(f"Output directory {out_dir} does not exist. Use -c to create", file=sys.stderr)
         sys.exit(1)
 
+files = {}           # relative destination path -> source path, overlapping modules (e.g. pkg and pkg.sub) are copied once
 for mod in modules:
     try:
-        copy_module(mod, out_dir)
+        for src, rel in module_files(mod):
+            files.setdefault(rel, src)
     except Exception as e:
         print(e, file=sys.stderr)
         sys.exit(1)
-    if "-q" not in opts:
-        print("copied:", mod)
+files = [(src, rel) for rel, src in files.items()]
+
+try:
+    if bundle is None:
+        ncopied = copy_files(files, out_dir, nthreads, "-f" in opts, "-H" in opts)
+        if "-q" not in opts:
+            print("modules:", " ".join(modules))
+            print(f"copied: {ncopied} files, unchanged: {len(files) - ncopied} files")
+    else:
+        nentries = make_bundle(files, bundle, nthreads, "-S" not in opts, opts.get("-e"))
+        if "-q" not in opts:
+            print("modules:", " ".join(modules))
+            print(f"bundle: {bundle}, {nentries} entries")
+except Exception as e:
+    print(f"Error copying modules: {e}", file=sys.stderr)
+    sys.exit(1)
@@ -74,8 +74,11 @@ class TracePoint(Tracer):
         return self
         
     def end(self):
-        self.Count += 1
-        self.Time += time.time() - self.T0
+        return self.add(time.time() - self.T0)
+
+    def add(self, t, count=1):
+        self.Count += count
+        self.Time += t
         return self
         
     def stats(self):
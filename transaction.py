@@ -1,39 +1,369 @@
+import time, re, threading, asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+
+# SQLSTATE codes of errors which are worth retrying: serialization failure and deadlock
+TransientSQLStates = ("40001", "40P01")
+TransientMessages = ("deadlock", "serialization failure", "could not serialize")
+
+def is_transient(exc):
+    state = getattr(exc, "pgcode", None) or getattr(exc, "sqlstate", None)
+    if state in TransientSQLStates:
+        return True
+    message = str(exc).lower()
+    return any(m in message for m in TransientMessages)
+
+LiteralRE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+InListRE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+SpaceRE = re.compile(r"\s+")
+
+def normalize_sql(sql):
+    # strip literals so that statements differing only in values are grouped together
+    sql = LiteralRE.sub("?", sql)
+    sql = InListRE.sub("(?)", sql)
+    return SpaceRE.sub(" ", sql).strip()
+
+class TransactionMonitor(object):
+
+    Buckets = (0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0)     # seconds
+
+    def __init__(self, tracer=None, point="db", slow_threshold=None, logger=None, slow_channel=None, buckets=None):
+        #
+        # tracer: Tracer to record timing into, under tracer[point]. Points: "execute/<normalized SQL>", "commit", "rollback",
+        #       "begin", "savepoint", "release", "rollback_to". Other points of the tracer are not touched.
+        # slow_threshold: seconds, statements taking longer are sent to the logger
+        # slow_channel: logger channel for slow statements, default - the "log" channel.
+        #       Non-default channel must be added to the Logger with Logger.add_channel(), otherwise the messages are dropped
+        #
+        # trace and logs are imported here so that Transaction can be used without them
+        from logs import Logged
+        if tracer is None:
+            from trace import Tracer
+            tracer = Tracer()
+        self.Log = Logged("Transaction", logger=logger)
+        self.Tracer = tracer[point]
+        self.SlowThreshold = slow_threshold
+        self.SlowChannel = slow_channel
+        self.Buckets = tuple(buckets or self.Buckets)
+        self.Lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.Lock:
+            self.Tracer.Points = {}
+            self.Tracer.reset()
+            self.Histograms = {}        # key -> [count per bucket] + [overflow], key: "execute/<normalized SQL>" or operation
+            self.Rows = {}              # key -> total rows
+            self.Rollbacks = 0
+            self.SavepointRollbacks = 0
+
+    def record(self, op, sql, t, rows=None):
+        # keys follow the tracer paths: "execute/<normalized SQL>" or the operation name
+        normalized = normalize_sql(sql) if op == "execute" else None
+        key = op if normalized is None else op + "/" + normalized
+        with self.Lock:
+            self.Tracer.add(t)
+            point = self.Tracer[op].add(t)
+            if normalized is not None:
+                point[normalized].add(t)
+            histogram = self.Histograms.get(key)
+            if histogram is None:
+                histogram = self.Histograms[key] = [0] * (len(self.Buckets) + 1)
+            i = 0
+            while i < len(self.Buckets) and t > self.Buckets[i]:
+                i += 1
+            histogram[i] += 1
+            if rows is not None and rows >= 0:
+                self.Rows[key] = self.Rows.get(key, 0) + rows
+            if op == "rollback":
+                self.Rollbacks += 1
+            elif op == "rollback_to":
+                self.SavepointRollbacks += 1
+        if op == "execute" and self.SlowThreshold is not None and t >= self.SlowThreshold:
+            self.Log.log("slow query %.3fs:" % (t,), sql, channel=self.SlowChannel)
+
+    def execute(self, cursor, op, sql, *params, **args):
+        t0 = time.time()
+        try:
+            return cursor.execute(sql, *params, **args)
+        finally:
+            self.record(op, sql, time.time() - t0, getattr(cursor, "rowcount", None))
+
+    def format(self, as_list=False):
+        out = self.Tracer.format(as_list=True)
+        with self.Lock:
+            keys = sorted(self.Histograms.keys())
+            maxk = max([len(k) for k in keys] + [9])
+            headfmt = f"%-{maxk}s %8s " + " ".join(["%7s"] * (len(self.Buckets) + 1))
+            datafmt = f"%-{maxk}s %8s " + " ".join(["%7d"] * (len(self.Buckets) + 1))
+            out.append("")
+            out.append(headfmt % (("Statement", "Rows") + tuple("<=%g" % (b,) for b in self.Buckets) + (">%g" % (self.Buckets[-1],),)))
+            for k in keys:
+                rows = self.Rows.get(k)
+                out.append(datafmt % ((k, "" if rows is None else rows) + tuple(self.Histograms[k])))
+            out.append("")
+            out.append(f"Rollbacks: {self.Rollbacks}, rollbacks to savepoint: {self.SavepointRollbacks}")
+        if as_list:
+            return out
+        else:
+            return "\n".join(out)
+
+class Savepoint(object):
+
+    def __init__(self, transaction, name):
+        self.Transaction = transaction
+        self.Name = name
+        self.Active = False
+
+    def begin(self):
+        self.Transaction._execute("savepoint", f"savepoint {self.Name}")
+        self.Transaction.Savepoints.append(self)
+        self.Active = True
+        return self
+
+    def _pop(self):
+        stack = self.Transaction.Savepoints
+        while stack:
+            sp = stack.pop()
+            sp.Active = False
+            if sp is self:
+                break
+
+    def release(self):
+        if self.Active:
+            self.Transaction._execute("release", f"release savepoint {self.Name}")
+            self._pop()
+
+    def rollback(self):
+        # rolls back to the savepoint and discards it
+        if self.Active:
+            self.Transaction._execute("rollback_to", f"rollback to savepoint {self.Name}")
+            self.Transaction._execute("release", f"release savepoint {self.Name}")
+            self._pop()
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.Transaction.InTransaction:
+            return
+        if exc_type is not None:
+            self.rollback()
+        else:
+            self.release()
+
 class Transaction(object):
-    
-    def __init__(self, connection):
+
+    def __init__(self, connection, monitor=None):
         self.Connection = connection
+        self.Monitor = monitor
         self.Cursor = self.Connection.cursor()
         self.InTransaction = False
         self.Exc = None
         self.Failed = False
+        self.Savepoints = []
+        self.NextSavepoint = 0
+
+    def _execute(self, op, sql, *params, **args):
+        if self.Monitor is None:
+            return self.Cursor.execute(sql, *params, **args)
+        else:
+            return self.Monitor.execute(self.Cursor, op, sql, *params, **args)
 
     def begin(self):
-        self.Cursor.execute("begin")
+        self._execute("begin", "begin")
         self.InTransaction = True
-        
+        self.Savepoints = []
+
     def commit(self):
-        self.Cursor.execute("commit")
+        self._execute("commit", "commit")
         self.InTransaction = False
-        
+        self.Savepoints = []
+
     def rollback(self):
-        self.Cursor.execute("rollback")
+        self._execute("rollback", "rollback")
         self.InTransaction = False
-        
+        self.Savepoints = []
+
     def execute(self, *params, **args):
         if not self.InTransaction:
-            raise RintimeError("Transaction closed")
+            raise RuntimeError("Transaction closed")
         try:
-            self.Cursor.execute(*params, **args)
+            self._execute("execute", *params, **args)
         except:
-            self.rollback()
+            # inside a savepoint, leave it to the savepoint to roll back only the nested unit
+            if not self.Savepoints:
+                self.rollback()
             raise
 
+    def savepoint(self, name=None):
+        if not self.InTransaction:
+            raise RuntimeError("Transaction closed")
+        if name is None:
+            name = f"sp_{self.NextSavepoint}"
+            self.NextSavepoint += 1
+        return Savepoint(self, name)
+
+    def retry(self, func, *params, retries=3, transient=None, backoff=0.1, max_backoff=5.0, **args):
+        #
+        # Runs func(transaction, *params, **args) inside a savepoint. If it fails with a transient error,
+        # rolls back to the savepoint and runs it again, leaving the rest of the transaction intact.
+        #
+        # transient: None - use is_transient(), a tuple of exception classes, or a predicate: transient(exc) -> bool
+        #
+        if transient is None:
+            transient = is_transient
+        elif not callable(transient) or isinstance(transient, type):
+            exc_classes = transient
+            transient = lambda exc: isinstance(exc, exc_classes)
+        delay = backoff
+        attempt = 0
+        while True:
+            try:
+                with self.savepoint():
+                    return func(self, *params, **args)
+            except Exception as e:
+                attempt += 1
+                if not self.InTransaction or attempt > retries or not transient(e):
+                    raise
+            if delay > 0:
+                time.sleep(delay)
+                delay = min(delay*2, max_backoff)
+
     def __enter__(self):
         self.begin()
-        
+        return self
+
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is not None:
             self.Exc = (exc_type, exc_value, traceback)
-            self.rollback()
+            if self.InTransaction:
+                self.rollback()
         else:
             self.commit()
+
+class AsyncSavepoint(object):
+
+    def __init__(self, async_transaction, savepoint):
+        self.AsyncTransaction = async_transaction
+        self.Savepoint = savepoint
+
+    async def __aenter__(self):
+        await self.AsyncTransaction._call(self.Savepoint.begin)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await asyncio.shield(self.AsyncTransaction._call(self.Savepoint.__exit__, exc_type, exc_value, traceback))
+
+class AsyncTransaction(object):
+    #
+    # asyncio wrapper around Transaction. Blocking DB-API calls run on a bounded thread pool,
+    # one call at a time per transaction, so the connection is never used by two threads at once.
+    # The driver must allow the connection to be used from a thread other than the one which created it.
+    #
+
+    MaxWorkers = 8
+    DefaultExecutor = None
+    DefaultExecutorLock = threading.Lock()
+
+    def __init__(self, connection, monitor=None, executor=None):
+        self.Transaction = Transaction(connection, monitor=monitor)
+        self.Executor = executor or self.default_executor()
+        self.Lock = asyncio.Lock()
+        self.Pending = None             # concurrent.futures.Future of the call in progress
+        self.Exc = None
+
+    @classmethod
+    def default_executor(cls):
+        with cls.DefaultExecutorLock:
+            if cls.DefaultExecutor is None:
+                cls.DefaultExecutor = ThreadPoolExecutor(max_workers=cls.MaxWorkers, thread_name_prefix="AsyncTransaction")
+            return cls.DefaultExecutor
+
+    async def _wait_pending(self):
+        # if the caller was cancelled, the blocking call may still be running in its thread
+        pending = self.Pending
+        if pending is not None and not pending.done():
+            await asyncio.wait([asyncio.wrap_future(pending)])
+
+    async def _call(self, func, *params, **args):
+        async with self.Lock:
+            await self._wait_pending()
+            self.Pending = self.Executor.submit(functools.partial(func, *params, **args))
+            return await asyncio.wrap_future(self.Pending)
+
+    @property
+    def Cursor(self):
+        return self.Transaction.Cursor
+
+    @property
+    def InTransaction(self):
+        return self.Transaction.InTransaction
+
+    async def begin(self):
+        await self._call(self.Transaction.begin)
+
+    async def commit(self):
+        await self._call(self.Transaction.commit)
+
+    async def rollback(self):
+        await self._call(self.Transaction.rollback)
+
+    async def execute(self, *params, **args):
+        await self._call(self.Transaction.execute, *params, **args)
+        return self
+
+    async def fetchone(self):
+        return await self._call(self.Cursor.fetchone)
+
+    async def fetchmany(self, size=None):
+        if size is None:
+            return await self._call(self.Cursor.fetchmany)
+        return await self._call(self.Cursor.fetchmany, size)
+
+    async def fetchall(self):
+        return await self._call(self.Cursor.fetchall)
+
+    async def rows(self, batch_size=100):
+        while True:
+            batch = await self.fetchmany(batch_size)
+            if not batch:
+                break
+            for row in batch:
+                yield row
+
+    def __aiter__(self):
+        return self.rows()
+
+    def savepoint(self, name=None):
+        return AsyncSavepoint(self, self.Transaction.savepoint(name))
+
+    async def __aenter__(self):
+        await self._shielded(self.begin())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.Exc = self.Transaction.Exc = (exc_type, exc_value, traceback)
+            # shielded, so that the rollback completes even if the task is cancelled again
+            await asyncio.shield(self._rollback_if_open())
+        else:
+            await self._shielded(self.commit())
+
+    async def _shielded(self, coro):
+        # Runs begin or commit to completion even if the caller is cancelled while the call is running
+        # or waiting for a free thread. If it is cancelled or fails, rolls back the transaction if it is still open.
+        task = asyncio.ensure_future(coro)
+        try:
+            return await asyncio.shield(task)
+        except BaseException:
+            if not task.done():
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            await asyncio.shield(self._rollback_if_open())
+            raise
+
+    async def _rollback_if_open(self):
+        async with self.Lock:
+            await self._wait_pending()
+            if self.Transaction.InTransaction:
+                self.Pending = self.Executor.submit(self.Transaction.rollback)
+                await asyncio.wrap_future(self.Pending)